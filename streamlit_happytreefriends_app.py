@@ -1,13 +1,273 @@
 # Import the necessary libraries
+# Heavier libraries (LangChain Gemini, LangGraph, PIL, ...) are imported inside
+# the functions that use them, so the page renders quickly when there is no
+# API key or no image.
 import streamlit as st  # For creating the web app interface
-from langchain_google_genai import ChatGoogleGenerativeAI  # For interacting with Google Gemini via LangChain
-from langgraph.prebuilt import create_react_agent  # For creating a ReAct agent
-from langchain_core.messages import HumanMessage, AIMessage  # For message formatting
-from PIL import Image
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage, AIMessageChunk  # For message formatting
+from langchain_community.chat_message_histories import StreamlitChatMessageHistory  # For keeping chat history in session state
 import os
 from dotenv import load_dotenv
-import base64
-import mimetypes
+import textwrap
+from typing import Optional
+
+
+# Longest side (in pixels) of the image sent to Gemini. Larger uploads are
+# downscaled first, which keeps the request payload and image-token cost small.
+MAX_IMAGE_SIZE = 1024
+
+
+# MIME types for the file types accepted by the uploader.
+_MIME = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}
+
+
+# Number of recent user/assistant turns sent to the agent as-is. Older turns
+# are replaced by a short summary so the prompt doesn't grow with every turn.
+# The summary is only updated once another MAX_CONTEXT_TURNS turns have built
+# up, so the window holds between MAX_CONTEXT_TURNS and twice that many turns.
+MAX_CONTEXT_TURNS = 8
+
+
+# System prompt for the plant care agent.
+# The literal is dedented and stripped once at import time so no source
+# indentation is sent to Gemini as extra input tokens.
+SYSTEM_PROMPT = textwrap.dedent("""
+    You are a botanist and agronomist acting as a specialized chatbot for plant knowledge.
+    In addition to answering text-based questions, you can also analyze plant photos uploaded by users.
+
+    Main rules:
+    1. Focus only on plant-related topics: botany, cultivation, plant care, pests & diseases, plant benefits, ecology, horticulture, etc.
+    2. If the user uploads a photo of a plant:
+    - Analyze the visual condition (leaf color, spots, stem shape, soil condition, visible insects, etc.).
+    - Provide possible causes based on trusted botanical/agricultural literature.
+    - Explain the confidence level of your analysis (e.g., “strong indication of nitrogen deficiency, but it could also be caused by overwatering”).
+    - Give clear, actionable steps the user can take to address the issue.
+    - If further confirmation is required (such as climate, soil type, or plant variety), ask the user before giving a final solution.
+    - Remind the user that image analysis is an initial estimation and not a substitute for an in-person diagnosis by a local agronomist.
+    3. If the user asks a text-only question, answer with:
+    - A clear and simple explanation
+    - References to scientific or trustworthy sources (FAO, academic journals, universities, government agricultural resources, etc.) when relevant
+    - Practical steps the user can follow
+    4. Do not answer questions outside the scope of plant knowledge. Politely redirect if the question is irrelevant.
+    5. Always structure your answers in a clear format:
+    - Analysis / explanation
+    - References (if applicable)
+    - Step-by-step solutions or recommendations
+""").strip()
+
+
+# Build the LangGraph agent once per API key and share it across reruns and sessions.
+@st.cache_resource
+def _build_agent(api_key: str):
+    from langchain_google_genai import ChatGoogleGenerativeAI  # For interacting with Google Gemini via LangChain
+    from langgraph.prebuilt import create_react_agent  # For creating a ReAct agent
+
+    # Initialize the LLM with the API key
+    llm = ChatGoogleGenerativeAI(
+        model="gemini-2.5-flash",
+        google_api_key=api_key,
+        temperature=0.2,
+        streaming=True
+    )
+    # Create a simple ReAct agent with the LLM
+    return create_react_agent(
+        model=llm,
+        tools=[],  # No tools for this simple example
+        prompt=SystemMessage(content=SYSTEM_PROMPT)
+    )
+
+
+# Cheaper LLM used only to summarize older parts of the conversation.
+@st.cache_resource
+def _build_summarizer(api_key: str):
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    return ChatGoogleGenerativeAI(
+        model="gemini-2.5-flash-lite",
+        google_api_key=api_key,
+        temperature=0
+    )
+
+
+# Whether a message has an image attached.
+def _has_image(message: BaseMessage) -> bool:
+    return not isinstance(message.content, str) and any(
+        part.get("type") == "image_url" for part in message.content
+    )
+
+
+# Return the messages to send to the agent: the recent turns, plus a summary
+# of everything before them as a SystemMessage.
+# The summary is cached in `st.session_state` and only extended (with a cheap
+# model call) when a whole block of MAX_CONTEXT_TURNS turns has fallen out of
+# the window, instead of on every turn.
+def _context_messages(messages: list[BaseMessage]) -> list[BaseMessage]:
+    summarized = st.session_state.get("history_summary_count", 0)
+    # The history was cleared without resetting the summary, so it is stale.
+    if summarized > len(messages):
+        st.session_state.pop("history_summary", None)
+        st.session_state.pop("history_summary_count", None)
+        summarized = 0
+    if len(messages) - summarized > MAX_CONTEXT_TURNS * 4:
+        cut = len(messages) - MAX_CONTEXT_TURNS * 2
+        # Make sure the window starts with a user message.
+        while cut < len(messages) and not isinstance(messages[cut], HumanMessage):
+            cut += 1
+        new_lines = "\n".join(
+            f"{'User' if isinstance(m, HumanMessage) else 'Assistant'}: {_message_text(m)}"
+            for m in messages[summarized:cut]
+        )
+        summary = _build_summarizer(google_api_key).invoke(
+            "Summarize this plant care conversation in a few sentences, keeping any "
+            "details about the user's plants, symptoms and advice already given.\n\n"
+            f"Previous summary:\n{st.session_state.get('history_summary', '')}\n\n"
+            f"New messages:\n{new_lines}"
+        ).content
+        st.session_state.history_summary = summary
+        st.session_state.history_summary_count = summarized = cut
+    if summarized == 0:
+        return messages
+
+    window = messages[summarized:]
+    # The photo is attached to a single message. If that message has been
+    # summarized away, re-attach its image to the first message in the window
+    # so the model can still see it.
+    if window and not any(_has_image(m) for m in window):
+        image_messages = [m for m in messages[:summarized] if _has_image(m)]
+        if image_messages:
+            image_parts = [part for part in image_messages[-1].content if part.get("type") == "image_url"]
+            first = window[0]
+            text_parts = [{"type": "text", "text": first.content}] if isinstance(first.content, str) else first.content
+            window = [HumanMessage(content=text_parts + image_parts)] + window[1:]
+    return [SystemMessage(content=f"Summary of the earlier conversation: {st.session_state.history_summary}")] + window
+
+
+# Gemini client used for Batch Mode, shared across reruns and sessions.
+@st.cache_resource
+def _build_genai_client(api_key: str):
+    from google import genai  # For Gemini Batch Mode
+
+    return genai.Client(api_key=api_key)
+
+
+# Convert LangChain messages to the `contents` format used by the Gemini API.
+def _to_genai_contents(messages: list[BaseMessage]) -> list[dict]:
+    import base64
+
+    contents = []
+    for message in messages:
+        # System messages are sent separately as the system instruction.
+        if isinstance(message, SystemMessage):
+            continue
+        parts = []
+        if isinstance(message.content, str):
+            parts.append({"text": message.content})
+        else:
+            for part in message.content:
+                if part.get("type") == "text":
+                    parts.append({"text": part["text"]})
+                elif part.get("type") == "image_url":
+                    # Split "data:<mime>;base64,<data>" back into its pieces.
+                    header, data = part["image_url"]["url"].split(",", 1)
+                    parts.append({"inline_data": {
+                        "mime_type": header[len("data:"):].split(";")[0],
+                        "data": base64.b64decode(data)
+                    }})
+        contents.append({"role": "user" if isinstance(message, HumanMessage) else "model", "parts": parts})
+    return contents
+
+
+# Submit one or more conversations to Gemini Batch Mode and return the job name.
+# Batch jobs are cheaper but can take hours to finish, so we don't wait here;
+# `_batch_results` checks on the job during later reruns.
+def _submit_batch(messages_batch: list[list[BaseMessage]]) -> str:
+    client = _build_genai_client(google_api_key)
+    job = client.batches.create(
+        model="gemini-2.5-flash",
+        src=[
+            {
+                "contents": _to_genai_contents(messages),
+                "config": {
+                    "system_instruction": "\n\n".join(
+                        [SYSTEM_PROMPT] + [m.content for m in messages if isinstance(m, SystemMessage)]
+                    ),
+                    "temperature": 0.2
+                }
+            }
+            for messages in messages_batch
+        ]
+    )
+    return job.name
+
+
+# Return one answer per conversation once the batch job has finished,
+# or None while it is still running.
+# Errors that retrying won't fix (the job failed, is unknown, or returned
+# nothing) are raised as RuntimeError so the caller can drop the job.
+def _batch_results(job_name: str) -> Optional[list[str]]:
+    from google.genai import errors
+
+    try:
+        job = _build_genai_client(google_api_key).batches.get(name=job_name)
+    except errors.ClientError as e:
+        # 4xx errors, e.g. a deleted or unknown job.
+        raise RuntimeError(f"Could not get batch job: {e}") from e
+    done_states = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+    if job.state.name not in done_states:
+        return None
+    if job.state.name != "JOB_STATE_SUCCEEDED":
+        raise RuntimeError(f"Batch job ended with state {job.state.name}")
+    if not job.dest or not job.dest.inlined_responses:
+        raise RuntimeError("Batch job finished without any results")
+
+    answers = []
+    for inline_response in job.dest.inlined_responses:
+        if inline_response.error or not inline_response.response:
+            answers.append(f"An error occurred: {inline_response.error or 'no response'}")
+        else:
+            # `text` is None when the reply was blocked or empty.
+            answers.append(inline_response.response.text or "I'm sorry, I couldn't generate a response.")
+    return answers
+
+
+# Encode the uploaded image as a data URL only once per upload.
+# `st.cache_data` keys on the arguments, so the same bytes are never resized
+# or re-encoded on later reruns. The cache is shared by every session, so it is
+# bounded in size and age to keep memory from growing with each new upload.
+@st.cache_data(max_entries=16, ttl=3600)
+def _encode_data_url(img_bytes: bytes, name: str) -> str:
+    import binascii
+    import io
+    from PIL import Image, ImageOps
+
+    mime_type = _MIME[name.rsplit(".", 1)[-1].lower()]
+    image = Image.open(io.BytesIO(img_bytes))
+    # Phone photos are often stored sideways with an EXIF orientation tag.
+    # Re-encoding drops EXIF, so the rotation has to be applied to the pixels.
+    rotated = image.getexif().get(0x0112, 1) != 1
+    # Only resize and re-encode when the image is larger than needed or rotated.
+    if rotated or max(image.size) > MAX_IMAGE_SIZE:
+        image = ImageOps.exif_transpose(image)
+        # JPEG has no alpha channel, so put transparent images on a white
+        # background instead of letting `convert` leave whatever is underneath.
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image = image.convert("RGBA")
+            image = Image.alpha_composite(Image.new("RGBA", image.size, (255, 255, 255, 255)), image)
+        # Convert first: palette images would make `thumbnail` fall back to NEAREST.
+        image = image.convert("RGB")
+        image.thumbnail((MAX_IMAGE_SIZE, MAX_IMAGE_SIZE), Image.LANCZOS)
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=85, optimize=True)
+        img_bytes = buf.getvalue()
+        mime_type = "image/jpeg"
+    return f"data:{mime_type};base64,{binascii.b2a_base64(img_bytes, newline=False).decode('ascii')}"
+
+
+# Return the text part of a message, skipping any attached image blocks.
+def _message_text(message) -> str:
+    if isinstance(message.content, str):
+        return message.content
+    return "".join(part["text"] for part in message.content if part.get("type") == "text")
+
 
 # Load key from .env file
 load_dotenv()
@@ -35,143 +295,238 @@ with colu1:
             accept_multiple_files=False,
             help="Upload an image file (JPG, JPEG, PNG only)"
         )
+    # Keep the encoded image in session state, keyed by the upload's file id,
+    # so it is computed once and reused for every later message.
+    if uploaded_image is not None:
+        if st.session_state.get("image_file_id") != uploaded_image.file_id:
+            st.session_state["image_data_url"] = _encode_data_url(uploaded_image.getvalue(), uploaded_image.name)
+            st.session_state["image_file_id"] = uploaded_image.file_id
+            # A new image has not been sent to the agent yet.
+            st.session_state.image_sent = False
+        data_url = st.session_state["image_data_url"]
+    else:
+        st.session_state.pop("image_data_url", None)
+        st.session_state.pop("image_file_id", None)
+        data_url = None
 with colu2:
     if uploaded_image is not None:
-        image = Image.open(uploaded_image)
-        st.image(image, caption="Image for analysis")
+        # Show the cached, already downscaled data URL. Streamlit passes URL strings
+        # through to the browser as-is, so the upload is not decoded with PIL and
+        # resized again on every rerun (as it would be for raw bytes).
+        st.image(data_url, caption="Image for analysis", width=400)
+
+# Get the agent from the cached factory. `st.cache_resource` keys on the API key,
+# so changing the key builds a fresh agent while reruns (and other sessions
+# using the same key) reuse the existing one.
+try:
+    agent = _build_agent(google_api_key)
+except Exception as e:
+    # If the key is invalid, show an error and stop.
+    st.error(f"Invalid API Key or configuration error: {e}")
+    st.stop()
 
-# This block of code handles the creation of the LangGraph agent.
-# It's designed to be efficient: it only creates a new agent if one doesn't exist
-# or if the user has changed the API key in the sidebar.
 # We use `st.session_state` which is Streamlit's way of "remembering" variables
 # between user interactions (like sending a message or clicking a button).
-if ("agent" not in st.session_state) or (getattr(st.session_state, "_last_key", None) != google_api_key):
-    try:
-        # Initialize the LLM with the API key
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-2.5-flash",
-            google_api_key=google_api_key,
-            temperature=0.2
-        )
-        
-        # Create a simple ReAct agent with the LLM
-        st.session_state.agent = create_react_agent(
-            model=llm,
-            tools=[],  # No tools for this simple example
-            prompt="""You are a botanist and agronomist acting as a specialized chatbot for plant knowledge. 
-            In addition to answering text-based questions, you can also analyze plant photos uploaded by users.
-
-            Main rules:
-            1. Focus only on plant-related topics: botany, cultivation, plant care, pests & diseases, plant benefits, ecology, horticulture, etc.
-            2. If the user uploads a photo of a plant:
-            - Analyze the visual condition (leaf color, spots, stem shape, soil condition, visible insects, etc.).
-            - Provide possible causes based on trusted botanical/agricultural literature.
-            - Explain the confidence level of your analysis (e.g., “strong indication of nitrogen deficiency, but it could also be caused by overwatering”).
-            - Give clear, actionable steps the user can take to address the issue.
-            - If further confirmation is required (such as climate, soil type, or plant variety), ask the user before giving a final solution.
-            - Remind the user that image analysis is an initial estimation and not a substitute for an in-person diagnosis by a local agronomist.
-            3. If the user asks a text-only question, answer with:
-            - A clear and simple explanation
-            - References to scientific or trustworthy sources (FAO, academic journals, universities, government agricultural resources, etc.) when relevant
-            - Practical steps the user can follow
-            4. Do not answer questions outside the scope of plant knowledge. Politely redirect if the question is irrelevant.
-            5. Always structure your answers in a clear format:
-            - Analysis / explanation
-            - References (if applicable)
-            - Step-by-step solutions or recommendations
-            """
-        )
-        
-        # Store the new key in session state to compare against later.
-        st.session_state._last_key = google_api_key
-        # Since the key changed, we must clear the old message history.
-        st.session_state.pop("messages", None)
-    except Exception as e:
-        # If the key is invalid, show an error and stop.
-        st.error(f"Invalid API Key or configuration error: {e}")
-        st.stop()
+if getattr(st.session_state, "_last_key", None) != google_api_key:
+    # Store the new key in session state to compare against later.
+    st.session_state._last_key = google_api_key
+    # Since the key changed, we must clear the old message history.
+    st.session_state.pop("langchain_messages", None)
+    st.session_state.pop("history_summary", None)
+    st.session_state.pop("history_summary_count", None)
+    st.session_state.pop("batch_queue", None)
+    st.session_state.pop("batch_job", None)
+    st.session_state.image_sent = False
+
+# --- Sidebar for Settings ---
+
+with st.sidebar:
+    st.subheader("Settings")
+    # When enabled, new prompts are queued and sent together with Gemini Batch Mode.
+    batch_mode = st.toggle("Queue for batch (50% cheaper, async)")
+    # Initialize the batch queue (the user's queued HumanMessages, oldest first) if it doesn't exist.
+    if "batch_queue" not in st.session_state:
+        st.session_state.batch_queue = []
+    # The submitted batch job, if any: {"name": <job name>, "count": <number of queued prompts sent>}.
+    batch_job = st.session_state.get("batch_job")
+    st.caption(f"{len(st.session_state.batch_queue)} prompt(s) queued")
+    # Only one job at a time, so clicking again can't start a second paid job.
+    send_batch_button = st.button(
+        "Send queued prompts",
+        disabled=not st.session_state.batch_queue or batch_job is not None
+    )
+    check_batch_button = st.button("Check batch results", disabled=batch_job is None)
+    # Forget the job and the queued prompts, e.g. if the job is stuck.
+    discard_batch_button = st.button(
+        "Discard queued prompts",
+        disabled=not st.session_state.batch_queue and batch_job is None
+    )
 
 # --- 4. Chat History Management ---
 
-# Initialize the message history (as a list) if it doesn't exist.
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+# The history stores LangChain message objects directly in `st.session_state`
+# under the "langchain_messages" key, so it survives reruns and can be passed
+# to the agent as-is without being rebuilt every turn.
+history = StreamlitChatMessageHistory(key="langchain_messages")
 
-# --- 5. Display Past Messages ---
+# The chat display and input run as a fragment: sending a message reruns only
+# this function instead of the whole page (header images, uploader, sidebar).
+# Arguments are reused from the last full run when only the fragment reruns.
+@st.fragment
+def _chat(agent, history, data_url, batch_mode):
+    # --- 5. Display Past Messages ---
 
-# Loop through every message currently stored in the session state.
-for msg in st.session_state.messages:
-    # For each message, create a chat message bubble with the appropriate role ("user" or "assistant").
-    with st.chat_message(msg["role"]):
-        # Display the content of the message using Markdown for nice formatting.
-        st.markdown(msg["content"])
+    # Loop through every message currently stored in the history.
+    for msg in history.messages:
+        # For each message, create a chat message bubble with the appropriate role ("user" or "assistant").
+        with st.chat_message("user" if isinstance(msg, HumanMessage) else "assistant"):
+            # Display the content of the message using Markdown for nice formatting.
+            st.markdown(_message_text(msg))
 
-# --- 6. Handle User Input and Agent Communication ---
+    # Show queued batch prompts as pending, after the history they build on.
+    batch_job = st.session_state.get("batch_job")
+    for i, msg in enumerate(st.session_state.batch_queue):
+        with st.chat_message("user"):
+            st.markdown(_message_text(msg))
+            if batch_job is not None and i < batch_job["count"]:
+                st.caption("⏳ Sent in a batch job, waiting for results")
+            else:
+                st.caption("⏳ Queued for batch")
 
-# Create a chat input box at the bottom of the page.
-# The user's typed message will be stored in the 'prompt' variable.
+    # --- 6. Handle User Input and Agent Communication ---
 
-prompt = st.chat_input("Type your message here...")
-# Check if the user has entered a message.
-if prompt:
-    # 1. Add the user's message to our message history list.
-    st.session_state.messages.append({"role": "user", "content": prompt})
-    # 2. Display the user's message on the screen immediately for a responsive feel.
-    with st.chat_message("user"):
-        st.markdown(prompt)
+    # Create a chat input box at the bottom of the page.
+    # The user's typed message will be stored in the 'prompt' variable.
+    # Live chat is blocked while batch prompts are pending: their answers are
+    # added to the history later, and live turns would not see them.
+    batch_pending = bool(st.session_state.batch_queue) or batch_job is not None
+    if batch_pending and not batch_mode:
+        prompt = st.chat_input("Send or discard the queued prompts to chat live again.", disabled=True)
+    else:
+        prompt = st.chat_input("Type your message here...")
+    # Check if the user has entered a message.
+    if prompt:
+        # 1. Build the user's message.
+        # If an image is uploaded, attach it only to the first message after the upload,
+        # so the history holds one copy of it instead of one per message.
+        attach_image = data_url and not st.session_state.get("image_sent")
+        if attach_image:
+            user_message = HumanMessage(content=[
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": data_url}}
+            ])
+        else:
+            user_message = HumanMessage(content=prompt)
+
+        if attach_image:
+            st.session_state.image_sent = True
+
+        # In batch mode, queue the message. Each queued prompt is sent with the
+        # history plus every prompt queued before it (so the photo and earlier
+        # questions are included), and added to the history with its answer
+        # once the batch results come back.
+        if batch_mode:
+            st.session_state.batch_queue.append(user_message)
+            st.rerun()
+
+        # Add the user's message to the history.
+        history.add_message(user_message)
+        # 2. Display the user's message on the screen immediately for a responsive feel.
+        with st.chat_message("user"):
+            st.markdown(prompt)
+
+        # 3. Stream the assistant's response token by token.
+        # `stream_mode="messages"` yields (message chunk, metadata) pairs as the LLM generates them.
+        def token_gen():
+            context = _context_messages(history.messages)
+            for chunk, _ in agent.stream({"messages": context}, stream_mode="messages"):
+                if isinstance(chunk, AIMessageChunk) and isinstance(chunk.content, str):
+                    yield chunk.content
+
+        # 4. Display the assistant's response as it arrives.
+        # `st.write_stream` returns the full concatenated text once streaming finishes.
+        with st.chat_message("assistant"):
+            # Use a 'try...except' block to gracefully handle potential errors (e.g., network issues, API errors).
+            try:
+                answer = st.write_stream(token_gen())
+                if not answer:
+                    answer = "I'm sorry, I couldn't generate a response."
+                    st.markdown(answer)
+            except Exception as e:
+                # If any error occurs, create an error message to display to the user.
+                answer = f"An error occurred: {e}"
+                st.markdown(answer)
+        # 5. Add the assistant's response to the history.
+        history.add_ai_message(answer)
+
+
+_chat(agent, history, data_url, batch_mode)
 
-    # 3. Get the assistant's response.
-    # Use a 'try...except' block to gracefully handle potential errors (e.g., network issues, API errors).
+# --- Event Handler ---
+
+# Send all queued prompts as one Gemini batch job.
+# The queue is kept until the results have been added to the chat.
+if send_batch_button:
+    queue = st.session_state.batch_queue
     try:
-        # Convert the message history to the format expected by the agent
-        messages = []
-        if uploaded_image is not None:
-            img_bytes = uploaded_image.getvalue()
-            mime_type, _ = mimetypes.guess_type(uploaded_image.name)
-            base64_img = base64.b64encode(img_bytes).decode("utf-8")
-            data_url = f"data:{mime_type};base64,{base64_img}"
-        else:
-            data_url = None
-
-        for msg in st.session_state.messages:
-            if msg["role"] == "user":
-                # If image is uploaded, add it to the HumanMessage
-                if uploaded_image is not None and msg["content"] == prompt and data_url:
-                    messages.append(HumanMessage(content=[
-                        {"type": "text", "text": msg["content"]},
-                        {"type": "image_url", "image_url": {"url": data_url}}
-                    ]))
-                else:
-                    messages.append(HumanMessage(content=msg["content"]))
-            elif msg["role"] == "assistant":
-                messages.append(AIMessage(content=msg["content"]))
-
-        # Send the user's prompt to the agent
-        response = st.session_state.agent.invoke({"messages": messages})
-        
-        # Extract the answer from the response
-        if "messages" in response and len(response["messages"]) > 0:
-            answer = response["messages"][-1].content
-        else:
-            answer = "I'm sorry, I couldn't generate a response."
+        # Building the context may call the summarizer, so it sits inside the try too.
+        context = _context_messages(history.messages)
+        st.session_state.batch_job = {
+            "name": _submit_batch([context + queue[:i + 1] for i in range(len(queue))]),
+            "count": len(queue)
+        }
+    except Exception as e:
+        st.error(f"An error occurred: {e}")
+    else:
+        st.rerun()
 
+# Check whether the batch job has finished and, if so, add its results to the chat.
+if check_batch_button:
+    try:
+        answers = _batch_results(batch_job["name"])
+    except RuntimeError as e:
+        # The job failed, so forget it and let the queue be sent again.
+        st.session_state.pop("batch_job", None)
+        st.error(f"An error occurred: {e}")
     except Exception as e:
-        # If any error occurs, create an error message to display to the user.
-        answer = f"An error occurred: {e}"
+        st.error(f"An error occurred: {e}")
+    else:
+        if answers is None:
+            st.info("The batch job is still running. Check again later.")
+        elif len(answers) != batch_job["count"]:
+            # Results can't be matched to the queued prompts, so let them be sent again.
+            st.session_state.pop("batch_job", None)
+            st.error("The batch job returned an unexpected number of results.")
+        else:
+            # Build every message first, then extend the history in one step,
+            # so a failure can't leave only part of the results in the chat.
+            submitted = st.session_state.batch_queue[:batch_job["count"]]
+            new_messages = []
+            for user_message, answer in zip(submitted, answers):
+                new_messages += [user_message, AIMessage(content=answer)]
+            history.add_messages(new_messages)
+            st.session_state.batch_queue = st.session_state.batch_queue[batch_job["count"]:]
+            st.session_state.pop("batch_job", None)
+            st.rerun()
 
-    # 4. Display the assistant's response.
-    with st.chat_message("assistant"):
-        st.markdown(answer)
-    # 5. Add the assistant's response to the message history list.
-    st.session_state.messages.append({"role": "assistant", "content": answer})
+# Forget the batch job and the queued prompts.
+if discard_batch_button:
+    # If the photo was only in a discarded prompt, attach it to the next one again.
+    if any(_has_image(m) for m in st.session_state.batch_queue):
+        st.session_state.image_sent = False
+    st.session_state.batch_queue = []
+    st.session_state.pop("batch_job", None)
+    st.rerun()
 
-# --- Event Handler ---
-    
 # Handle the reset button click.
 # Reset event
 # if reset_button:
-#     # If the reset button is clicked, clear the agent and message history from memory.
-#     st.session_state.pop("agent", None)
-#     st.session_state.pop("messages", None)
+#     # If the reset button is clicked, clear the message history from memory.
+#     # The agent is shared through `_build_agent`'s cache, so it is kept.
+#     st.session_state.pop("langchain_messages", None)
+#     st.session_state.pop("history_summary", None)
+#     st.session_state.pop("history_summary_count", None)
+#     st.session_state.pop("batch_queue", None)
+#     st.session_state.pop("batch_job", None)
 #     # st.rerun() tells Streamlit to refresh the page from the top.
 #     st.rerun()